@@ -21,8 +21,62 @@
 # SOFTWARE.
 
 import random
-import copy
+import struct
+from collections import OrderedDict
 import numpy
+from board import Board, layout, encode_batch, winning_moves_batch, canonical_table
+
+
+# header of the files written by `EGreedyPlayer.save`: magic string, format version, symmetric flag,
+# rows, columns and k of the board, number of states, number of plays and step size,
+# padded so that the table that follows is aligned
+_MAGIC = b"TTTV"
+_VERSION = 1
+_HEADER = struct.Struct("<4sBBBBBxxxIQd")
+_HEADER_SIZE = 32
+
+# boards with up to 3^12 states get a dense value table (2 MB), larger ones a bounded hash table
+DENSE_LIMIT = 3 ** 12
+DEFAULT_MAX_STATES = 2 ** 20
+
+
+class LRUTable:
+    def __init__(self, max_states, default):
+        """
+        A value table for boards too big for a dense array: a hash table keyed by the code of the board,
+        that holds at most `max_states` entries and evicts the least recently used ones beyond that.
+        It supports the same indexing as a numpy array: by a single code or by an array of codes.
+        Args:
+            max_states (int): the maximum number of entries in the table
+            default (float): the value of the states that are not in the table
+        """
+        self.max_states = max_states
+        self.default = default
+        self._values = OrderedDict()
+        return
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, code):
+        if isinstance(code, numpy.ndarray):
+            return numpy.array([self[int(c)] for c in code.ravel()], dtype=numpy.float32).reshape(code.shape)
+        value = self._values.get(code)
+        if value is None:
+            return self.default
+        self._values.move_to_end(code)
+        return value
+
+    def __setitem__(self, code, value):
+        if isinstance(code, numpy.ndarray):
+            for c, v in zip(code.ravel(), numpy.broadcast_to(value, code.shape).ravel()):
+                self[int(c)] = v
+            return
+        self._values[code] = float(value)
+        self._values.move_to_end(code)
+        if len(self._values) > self.max_states:
+            self._values.popitem(last=False)
+        return
 
 
 class RandomPlayer:
@@ -33,18 +87,49 @@ class RandomPlayer:
     def get_action(state):
         """
         Given the current state of the board, selects a random move from all the available moves
+        Args:
+            state (Board): The current state of the board
         """
-        pos = random.randint(0, 8)
-        while state[pos] != " ":
-            pos = random.randint(0, 8)
-        return pos, None
+        return random.choice(state.free), None
+
+    @staticmethod
+    def get_actions(boards, rng):
+        """
+        Selects a random move for each board in a batch, uniformly among the free cells
+        Args:
+            boards (numpy.ndarray): an (N, n_cells) array of digits, see `board.encode_batch`
+            rng (numpy.random.Generator): the random number generator to draw the moves with
+        Returns:
+            (numpy.ndarray): the (N,) array of moves
+        """
+        scores = rng.random(boards.shape)
+        scores[boards != 0] = -1.
+        return scores.argmax(axis=1)
 
 
 class EGreedyPlayer:
     def __init__(self, marker, init_value=0.5, e_greedy=0., step_size=0.5,
                  decrement=0.9,
                  decrement_each=1000,
-                 learn=True):
+                 learn=True,
+                 symmetric=False,
+                 rows=3, cols=3, k=3,
+                 max_states=None,
+                 cache_size=None):
+        """
+        A player that learns the value of each state of the board by temporal difference
+        and plays e-greedily with respect to it.
+        Args:
+            symmetric (bool): if True, all the boards that are a rotation or a reflection of each other
+                              share the same entry of the value table
+            rows (int): the number of rows of the board
+            cols (int): the number of columns of the board
+            k (int): the number of markers in a row needed to win
+            max_states (int): if given, the value table is a hash table that holds at most `max_states` states,
+                              see `LRUTable`. Boards with more than `DENSE_LIMIT` states always use one.
+            cache_size (int): the maximum number of greedy moves remembered while in eval mode, see `get_action`.
+                              Defaults to no limit for dense tables, and to the size of the table for hash tables.
+        """
         self.marker = str(marker)
         self.learn = learn
         self.e_greedy = e_greedy
@@ -53,9 +138,29 @@ class EGreedyPlayer:
         self.decrement = decrement
         self.decrement_each = decrement_each
 
-        # we store each state of the board as a dict whose key is the hash of the list
-        # and the value is its state value
-        self.state_value = {}
+        # we store the value of each state of the board in a flat array
+        # indexed by the base-3 code of the board, or by its symmetry class.
+        # Boards too big for a dense array use a bounded hash table instead
+        self.layout = layout(rows, cols, k)
+        self.symmetric = symmetric
+        self.dense = max_states is None and self.layout.n_states <= DENSE_LIMIT
+        if symmetric and not self.dense:
+            raise ValueError("Symmetric value tables are only available for boards with up to {} states".format(DENSE_LIMIT))
+        if symmetric:
+            self._canonical, n_states = canonical_table(self.layout)
+        else:
+            self._canonical, n_states = None, self.layout.n_states
+        if self.dense:
+            self.state_value = numpy.full(n_states, init_value, dtype=numpy.float32)
+            # number of backups that touched each state, used to weight the tables when merging players
+            self.visits = numpy.zeros(n_states, dtype=numpy.uint32)
+        else:
+            self.state_value = LRUTable(max_states or DEFAULT_MAX_STATES, init_value)
+            self.visits = None
+
+        # while the table is frozen, the greedy move of each board never changes, so it is computed only once
+        self.cache_size = cache_size if cache_size is not None or self.dense else self.state_value.max_states
+        self._greedy_cache = OrderedDict()
         self.n_plays = 0
         return
 
@@ -64,20 +169,49 @@ class EGreedyPlayer:
         Enables updates of the state-value table while playing
         """
         self.learn = True
+        self.invalidate()
 
     def eval(self):
         """
-        Disables updates of the state-value table while playing
+        Disables updates of the state-value table while playing.
+        The greedy moves are cached until `train()` or `invalidate()` is called.
         """
         self.learn = False
 
+    def invalidate(self):
+        """
+        Clears the cache of the greedy moves.
+        Every method that changes the value table calls it; code that writes `state_value` directly must call it too.
+        """
+        self._greedy_cache.clear()
+        return
+
     def encode(self, state):
         """
-        Encodes the state of the board into a single string
+        Encodes the state of the board into its index in the value table.
+        This is the base-3 code of the board, from the perspective of the player,
+        or the index of its symmetry class if the player is symmetric.
+        Integers and arrays of integers are assumed to be base-3 codes already.
         Args:
-            state (List[str]): The board state as a list of strings: the player markers
+            state (Union[Board, List[str], int, numpy.ndarray]): The board state, a list of strings with the player markers,
+                                                                 or the base-3 code of the board
+        Returns:
+            (int): the index of the board in the value table, or its code for hash tables
         """
-        return "".join(state)
+        if isinstance(state, Board):
+            code = state.code(self.marker)
+        elif isinstance(state, (int, numpy.integer, numpy.ndarray)):
+            code = state
+        else:
+            code = 0
+            for pos, cell in enumerate(state):
+                if cell == self.marker:
+                    code += self.layout.powers[pos]
+                elif cell != " ":
+                    code += 2 * self.layout.powers[pos]
+        if self.symmetric:
+            return self._canonical[code]
+        return code
 
     def set_value(self, state, value):
         """
@@ -86,8 +220,9 @@ class EGreedyPlayer:
             state (List[str]): The board state as a list of strings: the player markers
             value (float): the probability of winning in that state
         """
-        encoded = self.encode(state)
-        self.state_value[encoded] = value
+        self.state_value[self.encode(state)] = value
+        if not self.learn:
+            self.invalidate()
         return
 
     def get_value(self, state):
@@ -99,33 +234,131 @@ class EGreedyPlayer:
             (float): the value of the state, if already visited, the initial value otherwise
 
         """
-        encoded = self.encode(state)
-        if encoded in self.state_value:
-            return self.state_value[encoded]
-        else:
-            return self.init_value
+        return float(self.state_value[self.encode(state)])
 
     def back_up(self, state, next_state, next_value):
         """
         Performs a backup update of the current state using temporal difference learning
         Args:
-            state (List[str]): The current state of the board as a list of strings: the player markers
-            next_state (List[str]): The state of the board if we had to make this move, as a list of strings
+            state (Union[List[str], int]): The current state of the board as a list of strings, or its code
+            next_state (Union[List[str], int]): The state of the board if we had to make this move, or its code
             next_value (float): the value of the next state, if we had to make this move
         """
         current_value = self.get_value(state)
         self.set_value(next_state, next_value)
+        if self.visits is not None:
+            self.visits[self.encode(state)] += 1
+            self.visits[self.encode(next_state)] += 1
 
         # TD update
         new_value = current_value + self.step_size * (next_value - current_value)
         self.set_value(state, new_value)
         return
 
+    def back_up_batch(self, codes, next_codes, next_values):
+        """
+        Performs the backup of `back_up` for a batch of moves at once.
+        When the same state appears more than once in the batch, it is updated a single time
+        towards the mean of its targets.
+        Args:
+            codes (numpy.ndarray): the (N,) codes of the current states
+            next_codes (numpy.ndarray): the (N,) codes of the states reached with the moves
+            next_values (numpy.ndarray): the (N,) values of the states reached with the moves
+        """
+        codes, next_codes = self.encode(codes), self.encode(next_codes)
+        self.state_value[next_codes] = next_values
+
+        # TD update
+        states, inverse, counts = numpy.unique(codes, return_inverse=True, return_counts=True)
+        if self.visits is not None:
+            numpy.add.at(self.visits, next_codes, 1)
+            self.visits[states] += counts.astype(self.visits.dtype)
+        targets = numpy.bincount(inverse, weights=next_values, minlength=len(states)) / counts
+        current_values = self.state_value[states]
+        self.state_value[states] = current_values + self.step_size * (targets - current_values)
+        return
+
+    def save(self, path):
+        """
+        Saves the value table, the step size and the play count into a compact binary file:
+        a fixed-size header followed by the raw float32 table.
+        Args:
+            path (str): the path of the file to write
+        """
+        if not self.dense:
+            raise ValueError("Only dense value tables can be saved")
+        header = _HEADER.pack(_MAGIC, _VERSION, self.symmetric, self.layout.rows, self.layout.cols, self.layout.k,
+                              len(self.state_value), self.n_plays, self.step_size)
+        with open(path, "wb") as f:
+            f.write(header.ljust(_HEADER_SIZE, b"\0"))
+            f.write(numpy.ascontiguousarray(self.state_value, dtype=numpy.float32).tobytes())
+        return
+
+    @classmethod
+    def load(cls, path, marker, mmap=False, **kwargs):
+        """
+        Loads a player saved with `save`.
+        Args:
+            path (str): the path of the file to read
+            marker (str): the marker of the player
+            mmap (bool): if True, the value table is memory-mapped read-only instead of being copied in memory,
+                         so that many processes can share the same table. The player is returned in eval mode,
+                         and it cannot be trained.
+            **kwargs: the other arguments of the player, see `EGreedyPlayer.__init__`
+        Returns:
+            (EGreedyPlayer): the loaded player
+        """
+        with open(path, "rb") as f:
+            header = f.read(_HEADER_SIZE)
+        magic, version = header[:4], header[4]
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("{} is not a value table saved by EGreedyPlayer.save".format(path))
+        _, _, symmetric, rows, cols, k, n_states, n_plays, step_size = _HEADER.unpack(header[:_HEADER.size])
+
+        player = cls(marker, step_size=step_size, symmetric=bool(symmetric), rows=rows, cols=cols, k=k, **kwargs)
+        if len(player.state_value) != n_states:
+            raise ValueError("The table in {} has {} states, expected {}".format(path, n_states, len(player.state_value)))
+        if mmap:
+            player.state_value = numpy.memmap(path, dtype=numpy.float32, mode="r", offset=_HEADER_SIZE, shape=(n_states,))
+            player.eval()
+        else:
+            player.state_value = numpy.fromfile(path, dtype=numpy.float32, count=n_states, offset=_HEADER_SIZE)
+        player.n_plays = n_plays
+        player.invalidate()
+        return player
+
+    def merge(self, players):
+        """
+        Merges the value tables learnt by copies of this player into its own table.
+        Each state takes the average of the values of the copies, weighted by the number of times
+        each copy visited it; states that no copy visited keep their current value.
+        The copies are expected to have started from this player, with their visit counts set to zero.
+        Args:
+            players (List[EGreedyPlayer]): the copies of the player to merge
+        """
+        if not self.dense:
+            raise ValueError("Only dense value tables can be merged")
+        visits = numpy.zeros(self.state_value.shape, dtype=numpy.float64)
+        weighted = numpy.zeros(self.state_value.shape, dtype=numpy.float64)
+        for player in players:
+            visits += player.visits
+            weighted += player.visits * player.state_value.astype(numpy.float64)
+        visited = visits > 0
+        self.state_value[visited] = weighted[visited] / visits[visited]
+        self.visits += visits.astype(self.visits.dtype)
+        self.invalidate()
+
+        # decay the step size as if all the plays were made by this player
+        n_plays = self.n_plays + sum(player.n_plays - self.n_plays for player in players)
+        self.step_size *= self.decrement ** (n_plays // self.decrement_each - self.n_plays // self.decrement_each)
+        self.n_plays = n_plays
+        return
+
     def get_action(self, state):
         """
         Computes the e-greedy action, according to the current state of the board.
         Args:
-            state (List[str]): The current state of the board
+            state (Board): The current state of the board
         Returns:
             (Tuple[int, float]): A tuple containing the best move and the reward deriving from it
         """
@@ -134,24 +367,21 @@ class EGreedyPlayer:
         if random.random() < self.e_greedy and self.learn:
             return RandomPlayer.get_action(state)
 
-        best_move = None
-        best_state = None
-        best_reward = -float("inf")
-        for pos in range(len(state)):
-            # check that the cell is free
-            if state[pos] == " ":
-                next_state = copy.deepcopy(state)
-                next_state[pos] = self.marker
-                reward = self.get_reward(next_state)
-
-                # choose greedily
-                if reward >= best_reward:
-                    best_move = pos
-                    best_state = next_state
-                    best_reward = reward
+        code = state.code(self.marker)
+        if not self.learn and code in self._greedy_cache:
+            # frozen table: the greedy move of this board was already computed
+            best_move, best_code, best_reward = self._greedy_cache[code]
+            if self.cache_size is not None:
+                self._greedy_cache.move_to_end(code)
+        else:
+            best_move, best_code, best_reward = self._greedy_search(state, code)
+            if not self.learn:
+                self._greedy_cache[code] = best_move, best_code, best_reward
+                if self.cache_size is not None and len(self._greedy_cache) > self.cache_size:
+                    self._greedy_cache.popitem(last=False)
 
         if self.learn:
-            self.back_up(state, best_state, best_reward)
+            self.back_up(code, best_code, best_reward)
 
         self.n_plays += 1
         if self.n_plays % self.decrement_each == 0:
@@ -159,54 +389,80 @@ class EGreedyPlayer:
 
         return best_move, best_reward
 
+    def _greedy_search(self, state, code):
+        """
+        Looks for the greedy move, by checking the value of the board after each move
+        Args:
+            state (Board): The current state of the board
+            code (int): The base-3 code of `state`
+        Returns:
+            (Tuple[int, int, float]): the best move, the code of the board after it and its reward
+        """
+        # the code of each candidate board only differs from the current one by the marker in `pos`
+        best_move = None
+        best_code = None
+        best_reward = -float("inf")
+        for pos in state.free:
+            next_code = code + self.layout.powers[pos]
+            if state.completes_line(pos, self.marker):
+                reward = 1  # won, win prob 1.
+            else:
+                reward = float(self.state_value[self.encode(next_code)])
+
+            # choose greedily, breaking ties in favour of the last cell of the board
+            if reward > best_reward or (reward == best_reward and pos > best_move):
+                best_move = pos
+                best_code = next_code
+                best_reward = reward
+        return best_move, best_code, best_reward
+
+    def get_actions(self, boards, rng):
+        """
+        Computes the e-greedy action for each board in a batch, backing up the value table for the greedy ones.
+        Args:
+            boards (numpy.ndarray): an (N, n_cells) array of digits from the perspective of the player, see `board.encode_batch`
+            rng (numpy.random.Generator): the random number generator used for exploration
+        Returns:
+            (numpy.ndarray): the (N,) array of moves
+        """
+        moves = numpy.empty(len(boards), dtype=numpy.int64)
+        greedy = numpy.ones(len(boards), dtype=bool)
+        if self.learn:
+            greedy = rng.random(len(boards)) >= self.e_greedy
+            moves[~greedy] = RandomPlayer.get_actions(boards[~greedy], rng)
+        boards = boards[greedy]
+
+        codes = encode_batch(boards, self.layout)
+        free = boards == 0
+        next_codes = numpy.where(free, codes[:, None] + self.layout.code_weights, 0)
+        rewards = numpy.where(winning_moves_batch(boards, layout=self.layout), 1., self.state_value[self.encode(next_codes)])
+        rewards[~free] = -numpy.inf
+
+        # choose greedily, breaking ties in favour of the last cell of the board, as `get_action` does
+        best_moves = rewards.shape[1] - 1 - rewards[:, ::-1].argmax(axis=1)
+        rows = numpy.arange(len(boards))
+        moves[greedy] = best_moves
+
+        if self.learn:
+            self.back_up_batch(codes, next_codes[rows, best_moves], rewards[rows, best_moves])
+
+        n_plays = self.n_plays + len(boards)
+        self.step_size *= self.decrement ** (n_plays // self.decrement_each - self.n_plays // self.decrement_each)
+        self.n_plays = n_plays
+        return moves
+
     def get_reward(self, state):
         """
         Computes the reward of the player at a given state of the board
         Args:
-            state (List[str]): The current state of the board
+            state (Board): The current state of the board
         Returns:
             (float): 1 if the move is a winning move, 0 is the state is making the player lose.
                      In all the other cases returns the probability of the current state as stored in the
                      state-value table.
         """
-        # row
-        for i in range(0, 9, 3):
-            if (state[i] == state[i + 1] == state[i + 2]):
-                # three in a row
-                if state[i] == self.marker:
-                    return 1  # won, win prop 1.
-                elif state[i] == " ":
-                    return self.get_value(state)  # row is empty
-                else:
-                    return 0  # lost, win prob 0.
-        # col
-        for i in range(3):
-            if (state[i] == state[i + 3] == state[i + 6]):
-                # three in a row
-                if state[i] == self.marker:
-                    return 1  # won, win prop 1.
-                elif state[i] == " ":
-                    return self.get_value(state)  # row is empty
-                else:
-                    return 0  # lost, win prob 0.
-        # diag
-        if (state[0] == state[4] == state[8]):
-            if not self.learn:
-                print("diag")
-            # three in a row
-            if state[0] == self.marker:
-                return 1  # won, win prop 1.
-            elif state[0] == " ":
-                return self.get_value(state)  # row is empty
-            else:
-                return 0  # lost, win prob 0.
-        # anti-diag
-        if (state[2] == state[4] == state[6]):
-            # three in a row
-            if state[2] == self.marker:
-                return 1  # won, win prop 1.
-            elif state[2] == " ":
-                return self.get_value(state)  # row is empty
-            else:
-                return 0  # lost, win prob 0.
-        return self.get_value(state)
\ No newline at end of file
+        if state.winner == self.marker:
+            return 1  # won, win prob 1.
+        elif state.winner is not None:
+            return 0  # lost, win prob 0.
+        return self.get_value(state)
@@ -0,0 +1,262 @@
+# MIT License
+
+# Copyright (c) 2020 Eduardo Pignatelli
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import functools
+import numpy
+
+
+class Layout:
+    def __init__(self, rows=3, cols=3, k=3):
+        """
+        The geometry of an m,n,k-game: a board of `rows` x `cols` cells where a player needs `k` markers in a row.
+        Everything here is precomputed once and shared by all the boards and players with the same geometry,
+        see `layout`.
+        Args:
+            rows (int): the number of rows of the board
+            cols (int): the number of columns of the board
+            k (int): the number of markers in a row needed to win
+        """
+        if k > max(rows, cols):
+            raise ValueError("A {}x{} board has no line of {} cells".format(rows, cols, k))
+        self.rows, self.cols, self.k = rows, cols, k
+        self.n_cells = rows * cols
+        # the number of boards, i.e. of base-3 codes
+        self.n_states = 3 ** self.n_cells
+        self.powers = [3 ** pos for pos in range(self.n_cells)]
+
+        # all the winning lines: horizontal, vertical, diagonal and anti-diagonal
+        grid = numpy.arange(self.n_cells).reshape(rows, cols)
+        lines = []
+        for r in range(rows):
+            for c in range(cols):
+                for dr, dc in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                    if 0 <= r + (k - 1) * dr < rows and 0 <= c + (k - 1) * dc < cols:
+                        lines.append(tuple(int(grid[r + i * dr, c + i * dc]) for i in range(k)))
+        self.lines = lines
+        # the indices of the lines that pass through each cell
+        self.cell_lines = [[l for l, line in enumerate(lines) if pos in line] for pos in range(self.n_cells)]
+
+        # the symmetries of the board, as permutations of the cells: the transformed board is `board[symmetry]`
+        if rows == cols:
+            symmetries = [numpy.rot90(grid, t) for t in range(4)] + [numpy.rot90(grid.T, t) for t in range(4)]
+        else:
+            symmetries = [grid, grid[::-1, ::-1], grid[:, ::-1], grid[::-1, :]]
+        self.symmetries = numpy.array([symmetry.ravel() for symmetry in symmetries])
+
+        # array versions of the tables above, used to play many boards at once.
+        # A batch of boards is an (N, n_cells) int8 array with the same digits used by the codes
+        self.line_cells = numpy.array(lines)
+        self.line_mask = numpy.zeros((len(lines), self.n_cells), dtype=numpy.int32)
+        for l, line in enumerate(lines):
+            self.line_mask[l, list(line)] = 1
+        # codes of batches are int64, which holds boards of up to 39 cells
+        self.code_weights = numpy.array(self.powers, dtype=numpy.int64) if self.n_cells <= 39 else None
+        return
+
+
+@functools.lru_cache(maxsize=None)
+def layout(rows=3, cols=3, k=3):
+    """
+    Returns the shared `Layout` of the m,n,k-game with the given geometry
+    """
+    return Layout(rows, cols, k)
+
+
+# the standard 3x3 Tic-Tac-Toe
+TIC_TAC_TOE = layout(3, 3, 3)
+N_CELLS = TIC_TAC_TOE.n_cells
+N_STATES = TIC_TAC_TOE.n_states
+POWERS = TIC_TAC_TOE.powers
+LINES = TIC_TAC_TOE.lines
+CELL_LINES = TIC_TAC_TOE.cell_lines
+SYMMETRIES = TIC_TAC_TOE.symmetries
+LINE_CELLS = TIC_TAC_TOE.line_cells
+LINE_MASK = TIC_TAC_TOE.line_mask
+CODE_WEIGHTS = TIC_TAC_TOE.code_weights
+
+
+def decode_batch(codes, layout=TIC_TAC_TOE):
+    """
+    Computes the board of each code in a batch, the inverse of `encode_batch`
+    Args:
+        codes (numpy.ndarray): an (N,) array of codes
+        layout (Layout): the geometry of the boards
+    Returns:
+        (numpy.ndarray): an (N, n_cells) int8 array of digits
+    """
+    return (numpy.asarray(codes)[:, None] // layout.code_weights % 3).astype(numpy.int8)
+
+
+@functools.lru_cache(maxsize=None)
+def canonical_table(layout=TIC_TAC_TOE):
+    """
+    Precomputes the lookup table that maps the code of every board to the index of its symmetry class,
+    i.e. to the same index for all the boards that are a rotation or a reflection of each other.
+    Args:
+        layout (Layout): the geometry of the boards
+    Returns:
+        (Tuple[numpy.ndarray, int]): the (3^n_cells,) lookup table and the number of symmetry classes
+    """
+    boards = decode_batch(numpy.arange(layout.n_states), layout)
+    # the canonical representative of a board is the symmetric variant with the smallest code
+    representatives = numpy.min([encode_batch(boards[:, symmetry], layout) for symmetry in layout.symmetries], axis=0)
+    classes, index = numpy.unique(representatives, return_inverse=True)
+    return index.astype(numpy.int32), len(classes)
+
+
+def encode_batch(boards, layout=TIC_TAC_TOE):
+    """
+    Computes the base-3 code of each board in a batch
+    Args:
+        boards (numpy.ndarray): an (N, n_cells) array of digits: 0 empty, 1 and 2 for the two players
+        layout (Layout): the geometry of the boards
+    Returns:
+        (numpy.ndarray): the (N,) array of codes
+    """
+    return boards.astype(numpy.int64) @ layout.code_weights
+
+
+def swap_batch(boards):
+    """
+    Swaps the digits of the two players, i.e. changes the perspective of a batch of boards
+    """
+    return numpy.where(boards == 0, 0, 3 - boards).astype(boards.dtype)
+
+
+def winning_moves_batch(boards, digit=1, layout=TIC_TAC_TOE):
+    """
+    Finds, for each board in a batch, the free cells that would complete a line for the player `digit`
+    Args:
+        boards (numpy.ndarray): an (N, n_cells) array of digits
+        digit (int): the digit of the player moving
+        layout (Layout): the geometry of the boards
+    Returns:
+        (numpy.ndarray): an (N, n_cells) boolean array
+    """
+    counts = (boards[:, layout.line_cells] == digit).sum(-1)
+    return ((counts == layout.k - 1).astype(numpy.int32) @ layout.line_mask > 0) & (boards == 0)
+
+
+def ended_batch(boards, layout=TIC_TAC_TOE):
+    """
+    Checks which boards in a batch have a winner or no free cells left
+    Args:
+        boards (numpy.ndarray): an (N, n_cells) array of digits
+        layout (Layout): the geometry of the boards
+    Returns:
+        (numpy.ndarray): an (N,) boolean array
+    """
+    lines = boards[:, layout.line_cells]
+    won = ((lines == 1).all(-1) | (lines == 2).all(-1)).any(-1)
+    return won | (boards != 0).all(-1)
+
+
+class Board:
+    def __init__(self, markers, rows=3, cols=3, k=3):
+        """
+        A Tic-Tac-Toe board that keeps track incrementally of everything the players need to know about it:
+        the number of markers of each player on each line, the free cells, the winner and the code of the board.
+        Any m,n,k-game is supported: the code of the board is a Python integer, so it never overflows.
+        Args:
+            markers (Tuple[str, str]): the markers of the two players
+            rows (int): the number of rows of the board
+            cols (int): the number of columns of the board
+            k (int): the number of markers in a row needed to win
+        """
+        self.markers = tuple(str(marker) for marker in markers)
+        self.layout = layout(rows, cols, k)
+        self.reset()
+        return
+
+    def reset(self):
+        """
+        Empties the board
+        """
+        n_cells = self.layout.n_cells
+        self.cells = [" " for x in range(n_cells)]
+        # free cells are kept in a list for O(1) sampling, together with their position in the list for O(1) removal
+        self.free = list(range(n_cells))
+        self._free_index = list(range(n_cells))
+        self.counts = {marker: [0] * len(self.layout.lines) for marker in self.markers}
+        # the base-3 code of the board from the perspective of each player
+        self.codes = {marker: 0 for marker in self.markers}
+        self.winner = None
+        return
+
+    def __getitem__(self, pos):
+        return self.cells[pos]
+
+    def __len__(self):
+        return self.layout.n_cells
+
+    def __iter__(self):
+        return iter(self.cells)
+
+    def code(self, marker):
+        """
+        Returns the base-3 code of the board: each cell contributes 0 if empty,
+        1 if it holds `marker`, 2 if it holds the other marker.
+        Args:
+            marker (str): the marker of the player whose perspective is used for the encoding
+        """
+        return self.codes[marker]
+
+    def completes_line(self, pos, marker):
+        """
+        Checks in O(1) whether placing `marker` in `pos` would give k in a row
+        Args:
+            pos (int): the index of a free cell
+            marker (str): the marker of the player moving
+        """
+        counts = self.counts[marker]
+        for l in self.layout.cell_lines[pos]:
+            if counts[l] == self.layout.k - 1:
+                return True
+        return False
+
+    def step(self, pos, marker):
+        """
+        Places `marker` on the cell `pos` and updates the line counters, the free cells, the winner and the codes.
+        Args:
+            pos (int): the index of a free cell
+            marker (str): the marker of the player moving
+        """
+        self.cells[pos] = marker
+
+        # swap-remove the cell from the free list
+        i = self._free_index[pos]
+        last = self.free.pop()
+        if last != pos:
+            self.free[i] = last
+            self._free_index[last] = i
+
+        counts = self.counts[marker]
+        for l in self.layout.cell_lines[pos]:
+            counts[l] += 1
+            if counts[l] == self.layout.k:
+                self.winner = marker
+
+        power = self.layout.powers[pos]
+        for m in self.codes:
+            self.codes[m] += power if m == marker else 2 * power
+        return
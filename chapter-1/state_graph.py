@@ -0,0 +1,139 @@
+# MIT License
+
+# Copyright (c) 2020 Eduardo Pignatelli
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import numpy
+from board import N_CELLS, N_STATES, CODE_WEIGHTS, TIC_TAC_TOE, decode_batch, encode_batch, ended_batch, swap_batch, LINE_CELLS
+
+
+class StateGraph:
+    def __init__(self):
+        """
+        The graph of all the positions of Tic-Tac-Toe that can be reached from the empty board, stored as index arrays.
+        Positions are encoded with the digit 1 for the player that moves first and 2 for the one that moves second.
+        Attributes:
+            codes (numpy.ndarray): the (S,) base-3 codes of the positions, the position id is the index in this array
+            index (numpy.ndarray): the (3^9,) map from a code to its position id, -1 for unreachable boards
+            successors (numpy.ndarray): the (S, 9) ids of the positions reached with each move, -1 for illegal moves
+            terminal (numpy.ndarray): the (S,) flags of the positions where the game is over
+            outcome (numpy.ndarray): the (S,) digit of the winner for the terminal positions, 0 otherwise or for draws
+            to_move (numpy.ndarray): the (S,) digit of the player that holds the turn
+        """
+        # enumerate the positions ply by ply, expanding only the ones where the game goes on
+        layers = [numpy.zeros(1, dtype=numpy.int64)]
+        for ply in range(N_CELLS):
+            boards = decode_batch(layers[-1])
+            boards = boards[~ended_batch(boards)]
+            digit = 1 if ply % 2 == 0 else 2
+            rows, cells = numpy.nonzero(boards == 0)
+            layers.append(numpy.unique(encode_batch(boards[rows]) + digit * CODE_WEIGHTS[cells]))
+        self.codes = numpy.concatenate(layers)
+        self.index = numpy.full(N_STATES, -1, dtype=numpy.int32)
+        self.index[self.codes] = numpy.arange(len(self.codes), dtype=numpy.int32)
+
+        boards = decode_batch(self.codes)
+        lines = boards[:, LINE_CELLS]
+        self.terminal = ended_batch(boards)
+        self.outcome = numpy.zeros(len(self.codes), dtype=numpy.int8)
+        self.outcome[((lines == 1).all(-1)).any(-1)] = 1
+        self.outcome[((lines == 2).all(-1)).any(-1)] = 2
+        self.to_move = numpy.where((boards == 1).sum(1) == (boards == 2).sum(1), 1, 2).astype(numpy.int8)
+
+        free = (boards == 0) & ~self.terminal[:, None]
+        next_codes = self.codes[:, None] + self.to_move[:, None] * CODE_WEIGHTS
+        self.successors = numpy.where(free, self.index[numpy.where(free, next_codes, 0)], -1)
+        return
+
+    def __len__(self):
+        return len(self.codes)
+
+    def solve(self, first=True, opponent_policy=None):
+        """
+        Computes the exact probability of winning of a player that plays greedily against a fixed opponent,
+        using synchronous dynamic programming sweeps over the whole graph.
+        A game lasts at most 9 plies, so the values are exact after at most 10 sweeps.
+        Args:
+            first (bool): if True the player moves first, otherwise second
+            opponent_policy (numpy.ndarray): the (S, 9) probabilities of each move of the opponent,
+                                             defaults to the uniformly random opponent of `RandomPlayer`
+        Returns:
+            (numpy.ndarray): the (S,) probabilities of winning of the player from each position
+        """
+        digit = 1 if first else 2
+        valid = self.successors >= 0
+        if opponent_policy is None:
+            opponent_policy = valid / numpy.maximum(valid.sum(1, keepdims=True), 1)
+        mine = ~self.terminal & (self.to_move == digit)
+        theirs = ~self.terminal & (self.to_move != digit)
+
+        values = (self.terminal & (self.outcome == digit)).astype(numpy.float64)
+        for sweep in range(N_CELLS + 1):
+            next_values = numpy.where(valid, values[self.successors], 0.)
+            new_values = values.copy()
+            new_values[mine] = numpy.where(valid, next_values, -numpy.inf)[mine].max(1)
+            new_values[theirs] = (opponent_policy * next_values)[theirs].sum(1)
+            if numpy.array_equal(new_values, values):
+                break
+            values = new_values
+        return values
+
+    def value_table(self, player, opponent_policy=None):
+        """
+        Computes the exact values of the states stored in the table of an `EGreedyPlayer`,
+        i.e. the positions right after one of its moves, both when it moves first and when it moves second.
+        The other entries of the table hold the initial value of the player.
+        The graph only covers the standard 3x3 game, so the player must have a dense table for it.
+        Args:
+            player (EGreedyPlayer): the player whose table layout is used
+            opponent_policy (numpy.ndarray): see `solve`
+        Returns:
+            (numpy.ndarray): an array with the same shape as `player.state_value`
+        """
+        if player.layout is not TIC_TAC_TOE:
+            raise ValueError("The state graph only covers 3x3 Tic-Tac-Toe, not {}x{} boards with {} in a row".format(
+                player.layout.rows, player.layout.cols, player.layout.k))
+        if not player.dense:
+            raise ValueError("Only dense value tables can be filled from the state graph")
+        table = numpy.full(player.state_value.shape, player.init_value, dtype=numpy.float32)
+        for first in (True, False):
+            digit = 1 if first else 2
+            values = self.solve(first, opponent_policy)
+            # the player has just moved when the opponent holds the turn, or would hold it if the game went on
+            just_moved = (self.to_move != digit) & (self.codes != 0)
+            boards = decode_batch(self.codes[just_moved])
+            if not first:
+                boards = swap_batch(boards)
+            table[player.encode(encode_batch(boards))] = values[just_moved]
+        return table
+
+    def warm_start(self, player, opponent_policy=None):
+        """
+        Initialises the value table of an `EGreedyPlayer` with the exact values of `value_table`
+        Args:
+            player (EGreedyPlayer): the player to initialise
+            opponent_policy (numpy.ndarray): see `solve`
+        Returns:
+            (EGreedyPlayer): the player
+        """
+        player.state_value[:] = self.value_table(player, opponent_policy)
+        player.invalidate()
+        return player
@@ -21,29 +21,41 @@
 # SOFTWARE.
 
 
+import copy
+import math
+import multiprocessing
+import os
+import random
+import time
+from statistics import NormalDist
+import numpy
 from agents import RandomPlayer, EGreedyPlayer
+from board import Board, ended_batch, swap_batch
 
 
 class TicTacToe:
-    def __init__(self, player, opponent):
+    def __init__(self, player, opponent, rows=3, cols=3, k=3):
         """
         Initialises a Tic-Tac-Toe environment, by specifying the two players in the game.
+        Any m,n,k-game can be played by changing the size of the board and the number of markers in a row to win.
+        Args:
+            rows (int): the number of rows of the board
+            cols (int): the number of columns of the board
+            k (int): the number of markers in a row needed to win
         """
-        self.board = [" " for x in range(9)]
+        self.board = Board((player.marker, opponent.marker), rows, cols, k)
         self.player = player
         self.opponent = opponent
 
         # init
         self.player_turn = True
-        self.moves_left = 9
         return
 
     def reset(self):
         """
         Resets the environment to the initial state: an empty board
         """
-        self.board = [" " for x in range(9)]
-        self.moves_left = 9
+        self.board.reset()
         return self.board, False
 
     def step(self):
@@ -57,74 +69,233 @@ class TicTacToe:
             player = self.opponent
 
         pos, reward = player.get_action(self.board)
-        self.board[pos] = player.marker
+        self.board.step(pos, player.marker)
 
         self.player_turn = not self.player_turn
-        self.moves_left -= 1
 
         return self.board, reward, self.game_ended()
 
-    def learn(self, n_games):
+    def learn(self, n_games, batch_size=None, seed=None, n_workers=None, sync_every=10000, verbose=True):
         """
         Plays `n_games` consecutively to let the player learn.
         Args:
             n_games (int): the number of games to learn from
+            batch_size (int): if given, the games are played `batch_size` at a time, in lockstep, see `learn_batch`
+            seed (int): the seed of the random number generator used by the batched and parallel games
+            n_workers (int): if given, the games are spread over `n_workers` processes, see `learn_parallel`
+            sync_every (int): number of games each worker plays between two merges of the value tables
+            verbose (bool): if True, prints the progress of the training
         """
+        if n_workers is not None:
+            return self.learn_parallel(n_games, n_workers, sync_every, batch_size, seed, verbose)
+        if batch_size is not None:
+            return self.learn_batch(n_games, batch_size, seed, verbose)
+
         self.player.train()
         for i in range(n_games):
-            print("Playing game {}\t".format(i), end="\r")
+            if verbose:
+                print("Playing game {}\t".format(i), end="\r")
             state, done = self.reset()
             while not done:
                 state, reward, done = self.step()
         return self.player
 
-    def play(self):
+    def learn_batch(self, n_games, batch_size=4096, seed=None, verbose=True):
+        """
+        Plays `n_games` to let the player learn, `batch_size` games at a time.
+        All the games of a batch are stored in an (N, n_cells) array and advance in lockstep:
+        at each ply the players pick their moves for all the boards at once, through their `get_actions`,
+        and the value table is backed up with one batched update.
+        Who moves first is drawn at random for each game.
+        Args:
+            n_games (int): the number of games to learn from
+            batch_size (int): the number of games played at the same time
+            seed (int): the seed of the random number generator
+            verbose (bool): if True, prints the progress of the training
+        """
+        layout = self.board.layout
+        if layout.code_weights is None:
+            raise ValueError("Batched games support boards of up to 39 cells, got {}".format(layout.n_cells))
+        rng = numpy.random.default_rng(seed)
+        self.player.train()
+        for start in range(0, n_games, batch_size):
+            if verbose:
+                print("Playing games {} to {}\t".format(start, min(start + batch_size, n_games)), end="\r")
+            n = min(batch_size, n_games - start)
+            # boards are stored from the perspective of the player: 1 for the player, 2 for the opponent
+            boards = numpy.zeros((n, layout.n_cells), dtype=numpy.int8)
+            done = numpy.zeros(n, dtype=bool)
+            player_turn = rng.random(n) < 0.5
+            for ply in range(layout.n_cells):
+                idx = numpy.flatnonzero(player_turn & ~done)
+                if len(idx):
+                    boards[idx, self.player.get_actions(boards[idx], rng)] = 1
+                idx = numpy.flatnonzero(~player_turn & ~done)
+                if len(idx):
+                    boards[idx, self.opponent.get_actions(swap_batch(boards[idx]), rng)] = 2
+                done |= ended_batch(boards, layout)
+                player_turn = ~player_turn
+        return self.player
+
+    def learn_parallel(self, n_games, n_workers=None, sync_every=10000, batch_size=None, seed=None, verbose=True):
+        """
+        Plays `n_games` to let the player learn, spreading the games over a pool of processes.
+        The training runs in rounds: in each round every worker trains its own copy of the player
+        for `sync_every` games, with its own seed, and the copies are then merged back into the player
+        with `EGreedyPlayer.merge`. The opponent is copied into each worker too, and what it learns is discarded.
+        Args:
+            n_games (int): the number of games to learn from
+            n_workers (int): the number of processes, defaults to the number of cores
+            sync_every (int): number of games each worker plays between two merges of the value tables
+            batch_size (int): if given, each worker plays its games in lockstep batches, see `learn_batch`
+            seed (int): the seed from which the seeds of the workers are derived
+            verbose (bool): if True, prints the progress of the training
+        """
+        if not self.player.dense:
+            raise ValueError("Only dense value tables can be merged, so a player with a hash table can not learn in parallel")
+        n_workers = n_workers or os.cpu_count()
+        seeds = numpy.random.SeedSequence(seed)
+        self.player.train()
+        played = 0
+        with multiprocessing.Pool(n_workers) as pool:
+            while played < n_games:
+                if verbose:
+                    print("Playing games {} to {}\t".format(played, n_games), end="\r")
+                per_worker = min(sync_every, math.ceil((n_games - played) / n_workers))
+                jobs = []
+                for child in seeds.spawn(n_workers):
+                    n = min(per_worker, n_games - played)
+                    if n <= 0:
+                        break
+                    player = copy.deepcopy(self.player)
+                    player.visits[:] = 0
+                    jobs.append((player, self.opponent, n, batch_size, int(child.generate_state(1)[0])))
+                    played += n
+                self.player.merge(pool.map(_learn_worker, jobs))
+        return self.player
+
+    def play(self, render=True):
         """
         Tests the skills of each player in the game by having a single game, whilst learning is disabled.
+        Args:
+            render (bool): if True, draws the board after each move
         """
         self.player.eval()
         state, done = self.reset()
         while not done:
             state, reward, done = self.step()
-            self.draw()
+            if render:
+                self.draw()
         return state, done
 
+    def tournament(self, n_games, n_workers=None, seed=None, confidence=0.95):
+        """
+        Plays `n_games` evaluation games between the player and the opponent, spread over a pool of processes,
+        with learning disabled for both and without drawing the boards. The players take turns to move first.
+        Args:
+            n_games (int): the number of games to play
+            n_workers (int): the number of processes, defaults to the number of cores.
+                             With a single worker the games are played in this process, on copies of the players.
+            seed (int): the seed from which the seeds of the workers are derived
+            confidence (float): the confidence level of the intervals on the rates
+        Returns:
+            (Dict[str, Any]): the number of games, the games played per second and,
+                              for each of "wins", "draws" and "losses" of the player, a tuple with the rate
+                              and the lower and upper bounds of its Wilson score interval
+        """
+        n_workers = n_workers or os.cpu_count()
+        layout = self.board.layout
+        seeds = numpy.random.SeedSequence(seed).spawn(n_workers)
+        jobs = []
+        for i, child in enumerate(seeds):
+            n = n_games // n_workers + (i < n_games % n_workers)
+            if n > 0:
+                jobs.append((self.player, self.opponent, layout.rows, layout.cols, layout.k, n,
+                             int(child.generate_state(1)[0])))
+
+        start = time.perf_counter()
+        if n_workers == 1:
+            counts = [_tournament_worker(copy.deepcopy(job)) for job in jobs]
+        else:
+            with multiprocessing.Pool(n_workers) as pool:
+                counts = pool.map(_tournament_worker, jobs)
+        elapsed = time.perf_counter() - start
+
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        results = {"n_games": n_games, "games_per_second": n_games / elapsed}
+        for i, key in enumerate(("wins", "draws", "losses")):
+            k = sum(count[i] for count in counts)
+            rate = k / n_games
+            # Wilson score interval
+            centre = (rate + z ** 2 / (2 * n_games)) / (1 + z ** 2 / n_games)
+            width = z / (1 + z ** 2 / n_games) * math.sqrt(rate * (1 - rate) / n_games + z ** 2 / (4 * n_games ** 2))
+            results[key] = (rate, max(0., centre - width), min(1., centre + width))
+        return results
+
     def game_ended(self):
         """
         Checks if the game reached its conclusing, either because there are no moves left,
         or because one of the two player has won.
+        The board keeps track of the winner and of the free cells, so this is O(1).
         """
-        if self.moves_left <= 0:
-            return True
-
-        state = self.board
-        # row
-        for i in range(0, 9, 3):
-            if (state[i] == state[i + 1] == state[i + 2]):
-                return state[i] != " "
-        # col
-        for i in range(3):
-            if (state[i] == state[i + 3] == state[i + 6]):
-                return state[i] != " "
-        # diag
-        if (state[0] == state[4] == state[8]):
-            return state[0] != " "
-        # anti-diag
-        if (state[2] == state[4] == state[6]):
-            return state[2] != " "
-
-        return False
+        return self.board.winner is not None or not self.board.free
 
     def draw(self):
         """
         Plots the current state of the board
         """
-        for i in range(0, 9, 3):
-            print(self.board[i:i + 3])
+        cols = self.board.layout.cols
+        for i in range(0, len(self.board), cols):
+            print(self.board[i:i + cols])
         print("State value:", self.player.get_value(self.board))
         print()
 
 
+def _learn_worker(job):
+    """
+    Trains a copy of a player in a worker process of `TicTacToe.learn_parallel`
+    Args:
+        job (Tuple[EGreedyPlayer, Any, int, int, int]): the player, the opponent, the number of games,
+                                                        the batch size and the seed
+    Returns:
+        (EGreedyPlayer): the trained copy of the player
+    """
+    player, opponent, n_games, batch_size, seed = job
+    random.seed(seed)
+    env = TicTacToe(player, opponent, player.layout.rows, player.layout.cols, player.layout.k)
+    return env.learn(n_games, batch_size=batch_size, seed=seed, verbose=False)
+
+
+def _tournament_worker(job):
+    """
+    Plays evaluation games in a worker process of `TicTacToe.tournament`
+    Args:
+        job (Tuple[Any, Any, int, int, int, int, int]): the player, the opponent, the rows, columns and k of the board,
+                                                        the number of games and the seed
+    Returns:
+        (Tuple[int, int, int]): the number of wins, draws and losses of the player
+    """
+    player, opponent, rows, cols, k, n_games, seed = job
+    random.seed(seed)
+    for p in (player, opponent):
+        if hasattr(p, "eval"):
+            p.eval()
+    env = TicTacToe(player, opponent, rows, cols, k)
+    wins, draws, losses = 0, 0, 0
+    for i in range(n_games):
+        state, done = env.reset()
+        env.player_turn = i % 2 == 0
+        while not done:
+            state, reward, done = env.step()
+        if env.board.winner == player.marker:
+            wins += 1
+        elif env.board.winner is None:
+            draws += 1
+        else:
+            losses += 1
+    return wins, draws, losses
+
+
 if __name__ == "__main__":
     opponent = RandomPlayer("O")
     player = EGreedyPlayer("X", init_value=0.5, e_greedy=0.3, step_size=0.5, decrement=0.8, decrement_each=10000)
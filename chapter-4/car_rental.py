@@ -38,10 +38,24 @@ DROPOFF_1_LAMBDA = 3
 REQUEST_2_LAMBDA = 4
 DROPOFF_B_LAMBDA = 2
 DISCOUNT = 0.9
+# the Poisson distributions are cut where the mass of their tail drops below this value
+POISSON_TAIL = 1e-12
+# the layout of a snapshot of policy iteration, for a `snapshots.SnapshotWriter`
+SNAPSHOT_DTYPE = np.dtype([
+    ("values", np.float64, (MAX_CARS + 1, MAX_CARS + 1)),
+    ("policy", np.int32, (MAX_CARS + 1, MAX_CARS + 1)),
+])
 
 
 class CarRental:
-    def __init__(self):
+    def __init__(self, poisson_tail=POISSON_TAIL):
+        """
+        Jack's car rental problem, with two locations that rent and receive cars independently.
+
+        Args:
+            poisson_tail (float): the mass of the tail of the Poisson distributions that is left out of the model
+        """
+        self.poisson_tail = poisson_tail
         self.reset()
         return
 
@@ -66,7 +80,6 @@ class CarRental:
         """
         Resets the state of the environment and returns an initial observation.
         """
-        self._poisson_prob = {}
         self.state_values = np.zeros((MAX_CARS + 1, MAX_CARS + 1))
         self.policy = np.zeros((MAX_CARS + 1, MAX_CARS + 1), np.int32)
         self._probs_1, self._rewards_1 = self.precompute_model(
@@ -138,6 +151,25 @@ class CarRental:
         action = max(-MAX_MOVE, min(MAX_MOVE, action))
         return action
 
+    def get_valid_actions(self, actions):
+        """
+        Clips the actions of every state at once to feasible moves, the array version of `get_valid_action`.
+
+        Args:
+            actions (numpy.ndarray): the (MAX_CARS + 1, MAX_CARS + 1, ...) number of cars to be moved in each state,
+                                     with any number of trailing axes of actions per state
+
+        Returns:
+            (numpy.ndarray): the feasible number of cars to be moved, with the shape of `actions`
+        """
+        actions = np.asarray(actions)
+        cars_at_1, cars_at_2 = np.indices((MAX_CARS + 1, MAX_CARS + 1))
+        trailing = (1,) * (actions.ndim - 2)
+        cars_at_1, cars_at_2 = cars_at_1.reshape(cars_at_1.shape + trailing), cars_at_2.reshape(cars_at_2.shape + trailing)
+        # Jack can't move more cars than he has available, and at most 5 cars
+        actions = np.minimum(np.maximum(actions, -cars_at_2), cars_at_1)
+        return np.clip(actions, -MAX_MOVE, MAX_MOVE)
+
     def get_available_actions(self, state):
         """
         Return the list of actions compatible with the current state of the system.
@@ -148,11 +180,32 @@ class CarRental:
         Returns:
             (List[int]): The list of actions compatible with the current state of the system.
         """
-        return list(range(max(-MAX_CARS, - state[1]), min(MAX_CARS, state[0]) + 1))
+        return list(range(max(-MAX_MOVE, - state[1]), min(MAX_MOVE, state[0]) + 1))
+
+    def poisson_distribution(self, lam):
+        """
+        Computes the probabilities of the numbers drawn from a poisson distribution with a lambda of `lam`,
+        from 0 up to the smallest number whose upper tail has a mass below `self.poisson_tail`.
+        `$p_n = e^(-λ) * Π_{k<=n} λ / k$`
+
+        Args:
+            lam (int): the λ parameter of the poisson distribution
+
+        Returns:
+            (numpy.ndarray): the probability that the number is `n`, for each `n` in the support that is kept
+        """
+        # a bound far beyond any useful cutoff, the tail is below 1e-30 there for the lambdas of the problem
+        n_max = int(lam + 20 * math.sqrt(lam) + 20)
+        ratios = lam / np.arange(1, n_max + 1)
+        pmf = math.exp(-lam) * np.cumprod(np.concatenate([[1.], ratios]))
+        tail = 1. - np.cumsum(pmf)
+        n = np.argmax(tail < self.poisson_tail) if (tail < self.poisson_tail).any() else n_max
+        return pmf[:n + 1]
 
     def poisson_probability(self, n, lam):
         """
-        Computes the probability that the number drawn from a poisson distribution is `n`, given a lamdda of `lam`.
+        Computes the probability that the number drawn from a poisson distribution is `n`, given a lamdda of `lam`,
+        as it is used in the model: 0 beyond the tail cut by `poisson_distribution`.
         `$p = e^(-λ) * (λ^n / n!)$
 
         Args:
@@ -162,44 +215,40 @@ class CarRental:
         Returns:
             (float): the probability that the number is `n`
         """
-        key = (n, lam)
-        if key not in self._poisson_prob:
-            self._poisson_prob[key] = math.exp(-lam) * \
-                (math.pow(lam, n) / math.factorial(n))
-        return self._poisson_prob[key]
+        pmf = self.poisson_distribution(lam)
+        return float(pmf[n]) if n < len(pmf) else 0.
 
     def precompute_model(self, lambda_requests, lambda_dropoffs):
         """
-        Precomputes the model dynamics for efficiency: the reward and the transition probabilities.
-        Calculates the expected rewards for a range of requests from 0 to MAX_CARS + max(ACTIONS) + 1, and stores them into a privare array.
-        Calculates the probability that the system transitions from a state `s` to a state `s'`.
+        Precomputes the model dynamics of one location for efficiency: the reward and the transition probabilities.
+        The state is the number of cars `n` in the morning, after the cars have been moved, from 0 to MAX_CARS + MAX_MOVE.
+        Calculates the expected reward of the cars rented during the day, and the probability
+        that the location has `new_n` cars in the evening, summing over all the requests and dropoffs at once.
 
         Args:
             lambda_requests (int): the λ parameter of the poisson distribution that describes the requests
             lambda_dropoffs (int): the λ parameter of the poisson distribution that describes the dropoffs
 
         Returns:
-            (Tuple[numpy.ndarray, numpy.ndarray]): The array of system transitions probabilities and the array of expected rewards
-        """
-        P, R = {}, {}
-        requests = 0
-        for requests in range(MAX_CARS + max(ACTIONS) + 1):
-            request_prob = self.poisson_probability(requests, lambda_requests)
-            for n in range(MAX_CARS + max(ACTIONS) + 1):
-                if n not in R:
-                    R[n] = 0.
-                R[n] += CAR_RENTAL_COST * request_prob * min(requests, n)
-            dropoffs = 0
-            for dropoffs in range(MAX_CARS + max(ACTIONS) + 1):
-                dropoffs_prob = self.poisson_probability(
-                    dropoffs, lambda_dropoffs)
-                for n in range(MAX_CARS + max(ACTIONS) + 1):
-                    satisfied_requests = min(requests, n)
-                    new_n = max(
-                        0, min(MAX_CARS, n + dropoffs - satisfied_requests))
-                    if (n, new_n) not in P:
-                        P[(n, new_n)] = 0.
-                    P[(n, new_n)] += request_prob * dropoffs_prob
+            (Tuple[numpy.ndarray, numpy.ndarray]): The (MAX_CARS + MAX_MOVE + 1, MAX_CARS + 1) transition probabilities
+                                                   and the (MAX_CARS + MAX_MOVE + 1,) expected rewards
+        """
+        n = np.arange(MAX_CARS + MAX_MOVE + 1)
+        request_probs = self.poisson_distribution(lambda_requests)
+        dropoff_probs = self.poisson_distribution(lambda_dropoffs)
+        requests = np.arange(len(request_probs))[:, None, None]
+        dropoffs = np.arange(len(dropoff_probs))[None, :, None]
+
+        # (requests, n) cars rented
+        satisfied_requests = np.minimum(requests[:, 0], n)
+        R = CAR_RENTAL_COST * request_probs @ satisfied_requests
+
+        # (requests, dropoffs, n) cars in the evening, accumulated into (n, new_n) bins
+        new_n = np.clip(n + dropoffs - satisfied_requests[:, None], 0, MAX_CARS)
+        probs = request_probs[:, None, None] * dropoff_probs[None, :, None]
+        bins = n * (MAX_CARS + 1) + new_n
+        P = np.bincount(bins.ravel(), weights=np.broadcast_to(probs, bins.shape).ravel(),
+                        minlength=len(n) * (MAX_CARS + 1)).reshape(len(n), MAX_CARS + 1)
         return P, R
 
     def bellman_expectation(self, state, action):
@@ -226,31 +275,54 @@ class CarRental:
                     (r + DISCOUNT * self.state_values[new_n1, new_n2])
         return state_value
 
+    def expected_values(self):
+        """
+        Computes the expected value of the next state for every morning state at once, i.e. after the cars have been moved.
+        The two locations evolve independently, so the transition probabilities are the product of those of each location,
+        and the sum over all the next states separates into two small matrix products: E = P1 · V · P2ᵀ
+
+        Returns:
+            (numpy.ndarray): the (MAX_CARS + MAX_MOVE + 1, MAX_CARS + MAX_MOVE + 1) expected values E[V(s') | morning state]
+        """
+        return self._probs_1 @ self.state_values @ self._probs_2.T
+
+    def bellman_expectation_table(self, actions):
+        """
+        Solves the bellman expectation equation for every state at once, the array version of `bellman_expectation`.
+        The expected values of all the morning states come from `expected_values`,
+        and each state gathers those of the morning state reached with its action.
+
+        Args:
+            actions (numpy.ndarray): the (MAX_CARS + 1, MAX_CARS + 1, ...) number of cars to be moved in each state,
+                                     with any number of trailing axes of actions per state
+
+        Returns:
+            (numpy.ndarray): the values of taking `actions` in each state, with the shape of `actions`
+        """
+        actions = self.get_valid_actions(actions)
+        expected = self.expected_values()
+        cars_at_1, cars_at_2 = np.indices((MAX_CARS + 1, MAX_CARS + 1))
+        trailing = (1,) * (actions.ndim - 2)
+        morning_n1 = cars_at_1.reshape(cars_at_1.shape + trailing) - actions
+        morning_n2 = cars_at_2.reshape(cars_at_2.shape + trailing) + actions
+        rewards = self._rewards_1[morning_n1] + self._rewards_2[morning_n2]
+        return -CAR_MOVE_COST * np.abs(actions) + rewards + DISCOUNT * expected[morning_n1, morning_n2]
+
     def policy_evaluation(self, theta=1e-3):
         """
         Computes the true value table for the current policy using iterative policy evaluation.
+        Each sweep updates all the states at once with `bellman_expectation_table`.
         At the end of the process it updates the state-value table with the newly computed value function.
 
         Returns:
             (numpy.ndarray): The value function of the current policy stored as a 2D array
         """
-        new_values = np.empty_like(self.state_values)
         while True:
-            # for each state s ∈ S
-            for available_A in range(MAX_CARS + 1):
-                for available_B in range(MAX_CARS + 1):
-                    state = (available_A, available_B)
-                    # a = π(s)
-                    action = self.policy[available_A, available_B]
-                    # V(s) = p(s, r | s' π(s)) * (R(s) + γ * V(s'))
-                    new_state_value = self.bellman_expectation(state, action)
-                    # according the the original lisp code, the evaluation is performed asynchronously:
-                    # http://incompleteideas.net/book/code/jacks.lisp
-                    new_values[state] = new_state_value
+            # V(s) = p(s, r | s' π(s)) * (R(s) + γ * V(s')), for each state s ∈ S and a = π(s)
+            new_values = self.bellman_expectation_table(self.policy)
             delta = np.max(np.abs(self.state_values - new_values))
             print("\t\tValue delta {:.5f}\t\t ".format(delta), end="\r")
-            self.state_values = new_values.copy()
-            new_values = np.empty_like(self.state_values)
+            self.state_values = new_values
             if delta < theta:
                 print()
                 return
@@ -258,34 +330,33 @@ class CarRental:
         raise ValueError(
             "The value table did not converge. Check your inputs or look for bugs.")
 
-    def policy_improvement(self):
+    def policy_improvement(self, tolerance=1e-9):
         """
         Makes one step of policy improvement following a greedy policy.
-        For each state of the model, it iterates through all the feasible actions and finds the greediest one.
+        The action values of all the states and all the moves in ACTIONS are computed at once with `bellman_expectation_table`,
+        and the moves that are not feasible in a state, i.e. that `get_valid_action` would clip, are masked out.
+        Ties are broken deterministically: a state keeps its current action if its value is within `tolerance` of the best one,
+        otherwise it takes the smallest move among those within `tolerance` of the best one.
         The current policy is updated synchronously for each state, i.e. only after all the states have been visited.
 
+        Args:
+            tolerance (float): moves whose value is within `tolerance` of the best one are considered ties
+
         Returns:
             (bool): True if the policy has not improved
         """
-        new_policy = np.empty_like(self.policy)
-        # for each state s ∈ S
-        for available_A in range(MAX_CARS + 1):
-            for available_B in range(MAX_CARS + 1):
-                state = (available_A, available_B)
-                best_action = self.policy[state]
-                best_value = -float("inf")
-                for action in self.get_available_actions(state):
-                    value = self.bellman_expectation(state, action)
-#                     print(state, action, value)
-                    if value > best_value:
-                        best_value = value
-                        best_action = action
-                new_policy[available_A, available_B] = best_action
+        actions = np.broadcast_to(np.array(ACTIONS, dtype=self.policy.dtype), self.policy.shape + (len(ACTIONS),))
+        feasible = self.get_valid_actions(actions) == actions
+        q = np.where(feasible, self.bellman_expectation_table(actions), -np.inf)
+
+        best = q >= q.max(axis=-1, keepdims=True) - tolerance
+        current = np.take_along_axis(best, (self.policy - ACTIONS[0])[..., None], axis=-1)[..., 0]
+        new_policy = np.where(current, self.policy, np.array(ACTIONS)[np.argmax(best, axis=-1)]).astype(self.policy.dtype)
         converged = (new_policy == self.policy).all()
-        self.policy = new_policy.copy()
+        self.policy = new_policy
         return converged
 
-    def policy_iteration(self, plot=False):
+    def policy_iteration(self, plot=False, sink=None):
         """
         Computes the optimal policy π* using policy iteration.
         Convergence is guaranteed since the MDP has only a finite number of policies.
@@ -293,6 +364,8 @@ class CarRental:
 
         Args:
             plot (bool): If true, self.render() will be called at each evaluation/iteration step
+            sink (snapshots.SnapshotWriter): If given, the value table of each evaluated policy and the policy itself
+                are appended to it after each evaluation step, see `SNAPSHOT_DTYPE`
 
         Returns:
             (numpy.ndarray): The optimal policy
@@ -307,6 +380,8 @@ class CarRental:
             # policy evaluation to update the value table
             print("\tEvaluating policy {}".format(iteration))
             self.policy_evaluation()
+            if sink is not None:
+                sink.append((self.state_values, self.policy))
 
             # policy improvement to update the current policy, based on the new value table
             print("\tImproving policy {}".format(iteration))
@@ -21,21 +21,57 @@
 # SOFTWARE
 
 
+import functools
 import math
 import random
 import matplotlib.pyplot as plt
 import numpy as np
 import matplotlib
+from numpy.lib.stride_tricks import sliding_window_view
 
 
 P_H = 0.4
 WIN = 100
+# the default number of bytes that a sweep can allocate at once
+MEMORY_BUDGET = 2 ** 28
+
+
+@functools.lru_cache(maxsize=None)
+def _infeasible_bands(width):
+    """
+    Masks the infeasible stakes of a chunk of `width` stakes, see `GamblersProblem.stake_chunks`.
+    In a chunk, the row i is the state a0 + i and the column j the stake a0 + j, and the stake is feasible
+    if j <= i and i + j < n_states, so the infeasible entries are all in the first and in the last `width` rows.
+    Args:
+        width (int): the number of stakes of the chunk
+    Returns:
+        (Tuple[numpy.ndarray, numpy.ndarray]): the (width, width) masks of the infeasible entries
+                                               of the first and of the last `width` rows of the chunk
+    """
+    i = np.arange(width)[:, None]
+    j = np.arange(width)[None, :]
+    return j > i, i + j >= width
 
 
 class GamblersProblem:
-    def __init__(self):
-        self.values = np.zeros((101,))
-        self.values[100] = 1
+    def __init__(self, goal=WIN, p_h=P_H, memory_budget=MEMORY_BUDGET):
+        """
+        The gambler's problem: the gambler bets a stake of its capital on the flip of a coin,
+        and wins when the capital reaches the goal, or loses when it drops to 0.
+        Many coins can be solved at once: the value tables and the policies then have a leading batch axis,
+        with the same shape as `p_h`, and every array operation below broadcasts over it with `...`.
+        Args:
+            goal (int): the capital that the gambler wants to reach
+            p_h (Union[float, numpy.ndarray]): the probability of heads, or an array of probabilities to solve together
+            memory_budget (int): the approximate number of bytes that a sweep can allocate at once.
+                                 The stakes are processed in chunks that fit it, so the memory grows linearly with the goal
+        """
+        self.goal = goal
+        self.p_h = np.asarray(p_h, dtype=np.float64)
+        self.memory_budget = memory_budget
+        # the value of a state is the probability of reaching the goal from it, so the goal is worth 1
+        self.values = np.zeros(self.p_h.shape + (goal + 1,))
+        self.values[..., goal] = 1
         return
 
     def __str__(self):
@@ -50,69 +86,143 @@ class GamblersProblem:
         ax[0].set_xlabel("Capital")
         l = []
         for v in values:
-            l.append(ax[0].plot(v,))
+            l.append(ax[0].plot(v.T))
         ax[0].legend(["sweep1", "sweep2", "sweep3",
                       "sweep32", "Final value function"])
 
         # plot policy
-        ax[1].plot(self.policy(), c="black")
+        ax[1].plot(self.policy().T, c="black")
         ax[1].set_ylabel("Final\nPolicy\n(stake)", rotation=0, labelpad=20)
         ax[1].set_xlabel("Capital")
         plt.show()
         return fig, ax
 
     def state_space(self):
-        return range(WIN + 1)
-
-    def action_space(self, state=WIN + 1):
-        return range(min(state, WIN - state) + 1)
-
-    def policy(self):
-        policy = np.empty_like(self.values, dtype=np.int32)
-        for state in self.state_space():
-            best_value, best_action = self.values[state], policy[state]
-            for action in self.action_space(state):
-                value = self.bellman_expectation(state, action)
-                if value > best_value:
-                    best_value = value
-                    best_action = action
-            policy[state] = action
-        return policy
+        return range(self.goal + 1)
+
+    def action_space(self, state):
+        return range(min(state, self.goal - state) + 1)
 
     def bellman_expectation(self, state, action):
-        return P_H * (int(state + action >= WIN) + self.values[state + action])
+        return self.p_h * self.values[..., state + action] + (1 - self.p_h) * self.values[..., state - action]
 
-    def value_iteration(self, plot=False):
+    def stake_chunks(self):
         """
-        Searches for the optimal state value table using value iteration to THETA
+        Makes a one step lookahead for every state and every stake, a chunk of stakes at a time.
+        The stake `a` is feasible in the states a <= s <= goal - a, so the chunk of the stakes `a0 <= a < a1`
+        only needs the states `a0 <= s <= goal - a0`. Their values V(s + a) and V(s - a) are read from
+        sliding windows over the value table, without copies, and each chunk has about `memory_budget` bytes.
+        Yields:
+            (Tuple[int, int, numpy.ndarray]): the first stake `a0`, the end of the stakes `a1`,
+                                              and the (..., goal - 2 * a0 + 1, a1 - a0) action values Q(s, a)
+                                              of the states `a0 <= s <= goal - a0`, -inf for the infeasible stakes
         """
-        iteration = 0
-        cache = []
-        while True:
-            print("Iterating through value table {}\t".format(iteration), end="\r")
-            cache.append(self.values.copy())
-            for state in self.state_space():
-                best_value = self.values[state]
-                for action in self.action_space(state):
-                    value = self.bellman_expectation(state, action)
-                    if value > best_value:
-                        best_value = value
-                self.values[state] = best_value
-
-            if iteration == 500:
-                print("\nStopped at {}".format(iteration))
-                return cache
+        goal = self.goal
+        # the chunks are wider where there are fewer feasible states, a chunk holds about 4 arrays of its size
+        budget = self.memory_budget // (32 * self.p_h.size)
+        chunks, a0 = [], 1
+        while a0 <= goal // 2:
+            a1 = min(goal // 2 + 1, a0 + max(1, budget // (goal - 2 * a0 + 1)))
+            chunks.append((a0, a1))
+            a0 = a1
+        if not chunks:
+            return
+        # V(s + a) is read forward and V(s - a) backward, both padded so that the infeasible stakes stay in bounds
+        width = max(a1 - a0 for a0, a1 in chunks)
+        padding = np.zeros(self.p_h.shape + (width - 1,))
+        forward = np.concatenate([self.values, padding], axis=-1)
+        backward = np.concatenate([self.values[..., ::-1], padding], axis=-1)
+        p_h = self.p_h[..., None, None]
+        for a0, a1 in chunks:
+            n_states = goal - 2 * a0 + 1
+            wins = sliding_window_view(forward[..., :goal + a1 - a0], a1 - a0, axis=-1)[..., 2 * a0:, :]
+            losses = sliding_window_view(backward[..., :goal + a1 - a0], a1 - a0, axis=-1)[..., 2 * a0:, :][..., ::-1, :]
+            q = p_h * wins + (1 - p_h) * losses
+            # the masks only cover the bands of rows that have infeasible stakes, and are shared by the chunks of a width
+            first, last = _infeasible_bands(a1 - a0)
+            np.copyto(q[..., :a1 - a0, :], -np.inf, where=first)
+            np.copyto(q[..., n_states - (a1 - a0):, :], -np.inf, where=last)
+            yield a0, a1, q
+
+    def action_values(self):
+        """
+        Computes the whole Q matrix, which takes O(goal^2) memory, see `stake_chunks`
+        Returns:
+            (numpy.ndarray): the (..., goal + 1, goal // 2 + 1) action values Q(s, a), -inf for the infeasible stakes
+        """
+        q = np.full(self.p_h.shape + (self.goal + 1, self.goal // 2 + 1), -np.inf)
+        for a0, a1, chunk in self.stake_chunks():
+            q[..., a0:self.goal - a0 + 1, a0:a1] = chunk
+        return q
 
-            if plot:
-                self.render()
-            iteration += 1
+    def policy(self, tolerance=1e-9):
+        """
+        Computes the greedy policy with respect to the current value table.
+        Ties are broken deterministically in favour of the smallest stake
+        among those whose value is within `tolerance` of the best one.
+        The best values come from a first pass over the chunks of `stake_chunks`,
+        the stakes within `tolerance` of them from a second one.
+        Args:
+            tolerance (float): stakes whose value is within `tolerance` of the best one are considered ties
+        Returns:
+            (numpy.ndarray): the (..., goal + 1) stake to play in each state, 0 in the terminal states
+        """
+        best = self.backup()
+        policy = np.zeros(self.values.shape, dtype=np.int32)
+        for a0, a1, q in self.stake_chunks():
+            states = slice(a0, self.goal - a0 + 1)
+            ties = q >= best[..., states, None] - tolerance
+            # only the states that have no smaller stake within tolerance yet
+            found = (policy[..., states] == 0) & ties.any(axis=-1)
+            policy[..., states][found] = a0 + np.argmax(ties[found], axis=-1)
+        return policy
 
-        raise ValueError(
-            "The policy did not converge. Check your inputs or look for bugs.")
+    def backup(self):
+        """
+        Applies the bellman optimality equation to all the states at once, keeping a running max over the chunks of stakes
+        Returns:
+            (numpy.ndarray): the new (..., goal + 1) value table
+        """
+        values = self.values.copy()
+        values[..., 1:self.goal] = -np.inf
+        for a0, a1, q in self.stake_chunks():
+            states = slice(a0, self.goal - a0 + 1)
+            np.maximum(values[..., states], q.max(axis=-1), out=values[..., states])
+        return values
+
+    def value_iteration(self, theta=1e-9, snapshots=(), max_sweeps=None, sink=None):
+        """
+        Searches for the optimal state value table using value iteration,
+        updating all the states at once with `backup`, until the largest change of a value is below `theta`.
+        With many coins, the sweeps go on until all of them have converged.
+        Args:
+            theta (float): the threshold on the max-norm of the change of the value table
+            snapshots (Iterable[int]): the sweeps after which a copy of the value table is kept
+            max_sweeps (int): if given, the maximum number of sweeps
+            sink (snapshots.SnapshotWriter): if given, the value table of every sweep is appended to it,
+                                             which must have the shape of `values`
+        Returns:
+            (List[numpy.ndarray]): the copies of the value table at the requested sweeps that were reached
+        """
+        snapshots = set(snapshots)
+        cache = []
+        sweep = 0
+        while max_sweeps is None or sweep < max_sweeps:
+            values = self.backup()
+            delta = np.max(np.abs(values - self.values))
+            self.values = values
+            sweep += 1
+            if sink is not None:
+                sink.append(values)
+            if sweep in snapshots:
+                cache.append(values.copy())
+            if delta < theta:
+                break
+        print("Stopped at {}".format(sweep))
+        return cache
 
 
 if __name__ == "__main__":
     env = GamblersProblem()
-    iterations = env.value_iteration()
-    env.render([iterations[0], iterations[2], iterations[3],
-                iterations[32], iterations[-1]])
+    iterations = env.value_iteration(theta=1e-12, snapshots=(1, 2, 3, 32))
+    env.render(iterations + [env.values])
@@ -0,0 +1,115 @@
+# MIT License
+
+# Copyright (c) 2020 Eduardo Pignatelli
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import struct
+import numpy as np
+
+# the largest number of snapshots that the header of a file has room for
+MAX_SNAPSHOTS = 10 ** 18
+
+
+class SnapshotWriter:
+    def __init__(self, path, shape, dtype=np.float64):
+        """
+        An append-only store for the iterates of a solver, e.g. its value tables and its policies.
+        The snapshots are streamed to a .npy file of shape (n_snapshots, *shape) as they are produced,
+        so the memory of the solver does not grow with the number of iterations.
+        The header of the file has a fixed length and its count is rewritten after the data of each snapshot,
+        so the file is valid at any time and can be opened with `read_snapshots` while the solver is still running.
+        Args:
+            path (str): the path of the file, it is overwritten if it exists
+            shape (Tuple[int, ...]): the shape of a snapshot
+            dtype (numpy.dtype): the type of a snapshot, a structured type stores many arrays together,
+                                 e.g. `[("values", np.float64, (21, 21)), ("policy", np.int32, (21, 21))]`
+        """
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        # the header is sized for the largest count, and padded to a multiple of 64 bytes like numpy does
+        self._header_size = -(-len(self._header(MAX_SNAPSHOTS)) // 64) * 64
+        self._file = open(path, "wb+")
+        self._write_header()
+        return
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        return
+
+    def _header(self, count, size=None):
+        header = repr({
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (count,) + self.shape,
+        })
+        # magic string, version and header length take 10 bytes, the header ends with a newline
+        if size is not None:
+            header = header.ljust(size - 11)
+        # the header length is a little-endian unsigned short, whatever the byte order of this machine
+        return np.lib.format.magic(1, 0) + struct.pack("<H", len(header) + 1) + (header + "\n").encode("latin1")
+
+    def _write_header(self):
+        self._file.seek(0)
+        self._file.write(self._header(self.count, self._header_size))
+        self._file.flush()
+        return
+
+    def append(self, snapshot):
+        """
+        Appends a snapshot at the end of the file
+        Args:
+            snapshot (Union[numpy.ndarray, Tuple[numpy.ndarray, ...]]): an array of the shape of the store,
+                                                                        or a tuple of arrays for structured types
+        """
+        snapshot = np.asarray(snapshot, dtype=self.dtype)
+        if snapshot.shape != self.shape:
+            raise ValueError("Expected a snapshot of shape {}, got {}".format(self.shape, snapshot.shape))
+        # the data is written before the count, so a reader never sees a snapshot that is not there yet
+        self._file.seek(0, 2)
+        self._file.write(np.ascontiguousarray(snapshot).tobytes())
+        self._file.flush()
+        self.count += 1
+        self._write_header()
+        return
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+        return
+
+
+def read_snapshots(path):
+    """
+    Opens a file written by `SnapshotWriter` memory-mapped, so the snapshots are read from disk on demand
+    Args:
+        path (str): the path of the file
+    Returns:
+        (numpy.ndarray): the read-only (n_snapshots, *shape) array of the snapshots written so far
+    """
+    return np.load(path, mmap_mode="r")